@@ -1,6 +1,6 @@
 import time
 
-from PyQt5.QtCore import pyqtSignal, pyqtSlot, QThread, Qt
+from PyQt5.QtCore import pyqtSignal, pyqtSlot, QThread, QTimer, Qt
 from PyQt5.QtWidgets import QApplication, QLabel, QDesktopWidget
 
 from worktime_tracker.worktime_tracker import WorktimeTracker
@@ -9,13 +9,24 @@ from worktime_tracker.worktime_tracker import WorktimeTracker
 class WorktimeTrackerThread(QThread, WorktimeTracker):
 
     state_changed = pyqtSignal()
+    check_period_ms = 1000  # The state has second-level granularity, no need to poll at 10 Hz
+    refresh_period = 1  # Minimum seconds between two UI refreshes when the state does not change
 
     def run(self):
-        while True:
-            state_changed = self.check_state()
-            if state_changed:
-                self.state_changed.emit()
-            time.sleep(0.1)
+        # Drive the checks from a timer on this thread's event loop instead of a busy polling loop
+        self._last_emit_time = 0
+        timer = QTimer()
+        timer.timeout.connect(self._check_state_and_emit, Qt.DirectConnection)
+        timer.start(self.check_period_ms)
+        self.exec_()
+
+    def _check_state_and_emit(self):
+        state_changed = self.check_state()
+        # Emit on state changes and at most once per refresh period otherwise, so the UI does not
+        # redraw (and rescan the logs) more often than needed
+        if state_changed or time.monotonic() - self._last_emit_time > self.refresh_period:
+            self.state_changed.emit()
+            self._last_emit_time = time.monotonic()
 
 
 class Window(QLabel):
@@ -41,7 +52,7 @@ class Window(QLabel):
 
     def start_thread(self):
         self.worktime_tracker_thread = WorktimeTrackerThread()
-        self.worktime_tracker_thread.state_changed.connect(self.update_text)
+        self.worktime_tracker_thread.state_changed.connect(self.update_text, Qt.QueuedConnection)
         self.worktime_tracker_thread.start()
 
     def lines(self):
@@ -1,4 +1,4 @@
-from datetime import datetime, timedelta
+import mmap
 import os
 from pathlib import Path
 
@@ -8,48 +8,56 @@ LOGS_PATH = REPO_DIR / '.logs/logs.tsv'
 LAST_CHECK_PATH = REPO_DIR / 'last_check.txt'
 SPACE_TYPES_PATH = REPO_DIR / 'space_types.json'
 LOGS_PATH.parent.mkdir(exist_ok=True)
+if not LOGS_PATH.exists():
+    LOGS_PATH.touch()  # Touching on every read would update the mtime and defeat the log caches
 
 
-def reverse_read_lines(filename, buf_size=8192):
+MMAP_CACHE = {}  # filename -> ((st_size, st_mtime_ns), mmap) to reuse mappings across calls
+
+
+def get_mmap(filename):
+    '''Returns a read-only mmap of the file, reusing the cached mapping while the file is unchanged'''
+    stat = os.stat(filename)
+    signature = (stat.st_size, stat.st_mtime_ns)
+    cached = MMAP_CACHE.get(str(filename))
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+    if cached is not None:
+        cached[1].close()
+        del MMAP_CACHE[str(filename)]
+    if stat.st_size == 0:
+        return None  # Cannot mmap an empty file
+    fd = os.open(filename, os.O_RDONLY)
+    try:
+        mapping = mmap.mmap(fd, 0, prot=mmap.PROT_READ)
+    finally:
+        os.close(fd)
+    if hasattr(mmap, 'MADV_RANDOM'):
+        mapping.madvise(mmap.MADV_RANDOM)  # We scan backward so kernel readahead would be wasted
+    MMAP_CACHE[str(filename)] = (signature, mapping)
+    return mapping
+
+
+def reverse_read_lines(filename):
     '''a generator that returns the lines of a file in reverse order'''
-    with open(filename) as fh:
-        segment = None
-        offset = 0
-        fh.seek(0, os.SEEK_END)
-        file_size = remaining_size = fh.tell()
-        while remaining_size > 0:
-            offset = min(file_size, offset + buf_size)
-            fh.seek(file_size - offset)
-            buffer = fh.read(min(remaining_size, buf_size))
-            remaining_size -= buf_size
-            lines = buffer.split('\n')
-            # the first line of the buffer is probably not a complete line so
-            # we'll save it and append it to the last line of the next buffer
-            # we read
-            if segment is not None:
-                # if the previous chunk starts right from the beginning of line
-                # do not concact the segment to the last line of new chunk
-                # instead, yield the segment first
-                if buffer[-1] != '\n':
-                    lines[-1] += segment
-                else:
-                    yield segment
-            segment = lines[0]
-            for index in range(len(lines) - 1, 0, -1):
-                if lines[index]:
-                    yield lines[index]
-        # Don't yield None if the file was empty
-        if segment is not None:
-            yield segment
+    mapping = get_mmap(filename)
+    if mapping is None:
+        return
+    end = len(mapping)
+    if mapping[end - 1:end] == b'\n':  # Don't yield an empty line for the trailing newline
+        end -= 1
+    while end > 0:
+        start = mapping.rfind(b'\n', 0, end) + 1  # Is 0 if there is no previous newline
+        if start != end:  # Skip empty lines
+            yield mapping[start:end].decode()
+        end = start - 1
 
 
 def seconds_to_human_readable(seconds):
-    assert seconds < 3600 * 24, 'More than one day not supported'
-    sign = (lambda x: ('', '-')[x < 0])(seconds)
-    seconds = int(abs(seconds))
-    sec = timedelta(seconds=seconds)
-    d = datetime(1, 1, 1) + sec
-    return f'{sign}{d.hour}h{d.minute:02d}m'
+    sign = '-' if seconds < 0 else ''
+    hours, remainder = divmod(int(abs(seconds)), 3600)
+    minutes = remainder // 60
+    return f'{sign}{hours}h{minutes:02d}m'
 
 
 def yield_lines(filepath):
@@ -1,13 +1,29 @@
+from array import array
+import atexit
+import bisect
 from collections import defaultdict
 from datetime import datetime, timedelta
+from functools import lru_cache
+import os
 import shutil
 import time
 
-from worktime_tracker.utils import LOGS_PATH, LAST_CHECK_PATH, reverse_read_lines, seconds_to_human_readable
+import numpy as np
+
+from worktime_tracker.utils import LOGS_PATH, LAST_CHECK_PATH, get_mmap, reverse_read_lines, seconds_to_human_readable
 from worktime_tracker.spaces import get_state
 
 
+STATES = ['work', 'personal', 'locked']
+STATE_CODES = {state: code for code, state in enumerate(STATES)}
+WORK_STATES = ['work']
+WORK_STATES_MASK = np.array([state in WORK_STATES for state in STATES])  # Indexed by state code
+
 ALL_LOGS = []
+LOG_TIMESTAMPS = array('d')  # Parallel to ALL_LOGS, to locate timestamps with bisect
+LOG_STATE_CODES = array('b')  # Parallel to ALL_LOGS, states as int codes for vectorized summations
+LOGS_SIGNATURE = None  # (st_size, st_mtime_ns) of the log file when ALL_LOGS was last synced
+LOGS_GENERATION = 0  # Bumped when the log file is replaced, open descriptors on it are then stale
 
 
 def write_last_check(timestamp):
@@ -20,41 +36,27 @@ def read_last_check_timestamp():
         return float(f.readline().strip())
 
 
-def maybe_fix_unfinished_work_state():
-    '''If the app was killed during a work state, it will count everything from this moment as work.
-    We want to fix it if this is the case'''
-    timestamp = time.time()
-    last_check_timestamp = read_last_check_timestamp()
-    last_timestamp, last_state = read_last_log()
-    if timestamp - last_check_timestamp < 60:
-        return
-    if last_state not in WorktimeTracker.work_states:
-        return
-    write_last_check(timestamp)
-    maybe_write_log(last_check_timestamp + 1, 'locked')
-
-
-def maybe_write_log(timestamp, state):
-    # TODO: lock file
-    _, last_state = read_last_log()
-    if last_state == state:
-        return
-    with LOGS_PATH.open('a') as f:
-        f.write(f'{timestamp}\t{state}\n')
-
-
 def parse_log_line(log_line):
     timestamp, state = log_line.strip().split('\t')
     return float(timestamp), state
 
 
 def get_all_logs():
-    # We don't reload all logs each time, just the new ones
-    global ALL_LOGS
+    # The log file is append-only, so while its size and mtime are unchanged we can reuse the
+    # loaded logs, and when it grows we only need to parse the new lines
+    global LOGS_SIGNATURE
+    stat = os.stat(LOGS_PATH)  # The single freshness check of the read path
+    signature = (stat.st_size, stat.st_mtime_ns)
+    if signature == LOGS_SIGNATURE:
+        return ALL_LOGS
+    if LOGS_SIGNATURE is not None and stat.st_size < LOGS_SIGNATURE[0]:
+        # The file shrank (e.g. rewrite_history), the loaded logs are stale
+        del ALL_LOGS[:]
+        del LOG_TIMESTAMPS[:]
+        del LOG_STATE_CODES[:]
     last_timestamp = 0
     if len(ALL_LOGS) > 0:
         last_timestamp, _ = ALL_LOGS[-1]  # Last loaded log
-    LOGS_PATH.touch()  # Creates file if it does not exist
     new_logs = []
     # Read file in reverse to find new logs that are not loaded yet
     for line in reverse_read_lines(LOGS_PATH):
@@ -63,20 +65,24 @@ def get_all_logs():
             break
         new_logs.append((timestamp, state))
     ALL_LOGS.extend(new_logs[::-1])
-    return ALL_LOGS.copy()
+    LOG_TIMESTAMPS.extend([timestamp for timestamp, _ in new_logs[::-1]])
+    LOG_STATE_CODES.extend([STATE_CODES[state] for _, state in new_logs[::-1]])
+    LOGS_SIGNATURE = signature
+    return ALL_LOGS
 
 
 def get_logs(start_timestamp, end_timestamp):
     end_timestamp = min(end_timestamp, time.time())
-    logs = [(end_timestamp, 'locked')]  # Add a virtual state at the end of the logs to count the last state
-    for timestamp, state in get_all_logs()[::-1]:  # Read the logs backward
-        if timestamp > end_timestamp:
-            continue
-        if timestamp < start_timestamp:
-            logs.append((start_timestamp, state))  # The first log will be dated at the start timestamp queried
-            break
-        logs.append((timestamp, state))
-    return logs[::-1]  # Order the list back to original because we have read the logs backward
+    all_logs = get_all_logs()
+    # Locate the queried window with bisect instead of scanning the logs backward
+    start_idx = bisect.bisect_left(LOG_TIMESTAMPS, start_timestamp)
+    end_idx = bisect.bisect_right(LOG_TIMESTAMPS, end_timestamp)
+    logs = all_logs[start_idx:end_idx]
+    if start_idx > 0 and (len(logs) == 0 or logs[0][0] > start_timestamp):
+        # The first log will be dated at the start timestamp queried
+        logs.insert(0, (start_timestamp, all_logs[start_idx - 1][1]))
+    logs.append((end_timestamp, 'locked'))  # Add a virtual state at the end of the logs to count the last state
+    return logs
 
 
 def read_last_log():
@@ -96,63 +102,116 @@ def read_first_log():
         return parse_log_line(first_line)
 
 
+def invalidate_logs_cache():
+    global LOGS_SIGNATURE, LOGS_GENERATION
+    LOGS_SIGNATURE = None
+    LOGS_GENERATION += 1
+    del ALL_LOGS[:]
+    del LOG_TIMESTAMPS[:]
+    del LOG_STATE_CODES[:]
+
+
+def get_line_offset(mapping, line_idx):
+    '''Byte offset of the start of the line_idx-th line of the mapped file'''
+    offset = 0
+    for _ in range(line_idx):
+        offset = mapping.find(b'\n', offset) + 1
+    return offset
+
+
 def rewrite_history(start_timestamp, end_timestamp, new_state):
     # Careful, this methods rewrites the entire log file
     shutil.copy(LOGS_PATH, f'{LOGS_PATH}.bck{int(time.time())}')
-    with LOGS_PATH.open('r') as f:
-        logs = get_logs(start_timestamp=0, end_timestamp=time.time())
-    assert end_timestamp < logs[-1][0], 'Rewriting the future not allowed'
-    # Remove logs that are in the interval to be rewritten
-    logs_before = [(timestamp, state) for (timestamp, state) in logs
-                   if timestamp < start_timestamp]
-    logs_after = [(timestamp, state) for (timestamp, state) in logs
-                  if timestamp > end_timestamp]
-    logs_inside = [(timestamp, state) for (timestamp, state) in logs
-                   if start_timestamp <= timestamp and timestamp <= end_timestamp]
-    if len(logs_inside) > 0:
-        # Push back last log inside to be the first of logs after (the rewritten history needs to end on the same
-        # state as it was actually recorded)
-        logs_after = [(f'{end_timestamp:.6f}', logs_inside[-1][1])] + logs_after
-    else:
+    assert end_timestamp < time.time(), 'Rewriting the future not allowed'
+    logs = get_all_logs()
+    # The logs are sorted by timestamp, locate the interval to be rewritten with bisect
+    start_idx = bisect.bisect_left(LOG_TIMESTAMPS, start_timestamp)
+    end_idx = bisect.bisect_right(LOG_TIMESTAMPS, end_timestamp)
+    if end_idx > start_idx:
+        # The rewritten history needs to end on the same state as it was actually recorded
+        boundary_state = logs[end_idx - 1][1]
+    elif end_idx < len(logs):
         # If there were no states inside, then just take the first log after
-        logs_after = [(f'{end_timestamp:.6f}', logs_after[0][1])] + logs_after
-    # Edge cases to not have two identical subsequent states
-    if logs_before[-1][1] == new_state:
+        boundary_state = logs[end_idx][1]
+    else:
+        boundary_state = 'locked'
+    # Edge case to not have two identical subsequent states
+    before_idx = start_idx
+    if start_idx > 0 and logs[start_idx - 1][1] == new_state:
         # Change the start date to the previous one if it is the same state
-        start_timestamp = logs_before[-1][0]
-        logs_before = logs_before[:-1]
-    if logs_after[0][1] == new_state:
-        # Remove first element if it is the same as the one we are going to introduce
-        logs_after = logs_after[1:]
-    new_logs = logs_before + [(f'{start_timestamp:.6f}', new_state)] + logs_after
-    with LOGS_PATH.open('w') as f:
-        for timestamp, state in new_logs:
-            f.write(f'{timestamp}\t{state}\n')
+        start_timestamp = logs[start_idx - 1][0]
+        before_idx = start_idx - 1
+    # Stream the untouched head and tail of the file byte-for-byte from the mapping instead of
+    # rebuilding every line in memory, then swap the new file in atomically
+    mapping = get_mmap(LOGS_PATH)
+    tmp_path = LOGS_PATH.with_suffix('.tmp')
+    with tmp_path.open('wb') as f:
+        f.write(mapping[:get_line_offset(mapping, before_idx)])
+        f.write(f'{start_timestamp:.6f}\t{new_state}\n'.encode())
+        if boundary_state != new_state:  # Same edge case as above for the end of the interval
+            f.write(f'{end_timestamp:.6f}\t{boundary_state}\n'.encode())
+        f.write(mapping[get_line_offset(mapping, end_idx):])
+    os.replace(tmp_path, LOGS_PATH)
+    invalidate_logs_cache()
+
+
+def get_cum_state_durations(start_timestamp, end_timestamp):
+    '''Cumulated seconds spent in each state over the window, as an array indexed by state code'''
+    assert start_timestamp < end_timestamp
+    end_timestamp = min(end_timestamp, time.time())
+    get_all_logs()  # Sync the loaded logs
+    timestamps = np.frombuffer(LOG_TIMESTAMPS, dtype=np.float64)
+    state_codes = np.frombuffer(LOG_STATE_CODES, dtype=np.int8)
+    start_idx = np.searchsorted(timestamps, start_timestamp, side='left')
+    end_idx = np.searchsorted(timestamps, end_timestamp, side='right')
+    window_timestamps = timestamps[start_idx:end_idx]
+    window_state_codes = state_codes[start_idx:end_idx]
+    if start_idx > 0 and (window_timestamps.size == 0 or window_timestamps[0] > start_timestamp):
+        # The state active at start_timestamp started before it, clamp it to the window
+        window_timestamps = np.concatenate(([start_timestamp], window_timestamps))
+        window_state_codes = np.concatenate(([state_codes[start_idx - 1]], window_state_codes))
+    # Each state lasts until the next timestamp, the last one until end_timestamp
+    durations = np.diff(np.append(window_timestamps, end_timestamp))
+    return np.bincount(window_state_codes, weights=durations, minlength=len(STATES))
 
 
 def get_cum_times_per_state(start_timestamp, end_timestamp):
-    assert start_timestamp < end_timestamp
+    cum_state_durations = get_cum_state_durations(start_timestamp, end_timestamp)
+    return defaultdict(float, {state: cum_state_durations[code] for state, code in STATE_CODES.items()})
+
+
+def get_cum_times_per_weekday_state(weekday_timestamps):
+    '''Computes the cumulated times per state of several weekdays in a single pass over the logs.
+    weekday_timestamps maps a weekday index to its (start_timestamp, end_timestamp)'''
+    weekdays = sorted(weekday_timestamps, key=lambda weekday: weekday_timestamps[weekday][0])
+    start_timestamp = weekday_timestamps[weekdays[0]][0]
+    end_timestamp = weekday_timestamps[weekdays[-1]][1]
     logs = get_logs(start_timestamp, end_timestamp)
-    cum_times_per_state = defaultdict(float)
-    current_state_start_timestamp, current_state = logs[0]
-    for new_timestamp, new_state in logs[1:]:
-        if new_state == current_state:
-            continue
-        cum_times_per_state[current_state] += (new_timestamp - max(current_state_start_timestamp, start_timestamp))
-        current_state = new_state
-        current_state_start_timestamp = new_timestamp
-    return cum_times_per_state
+    cum_times_per_weekday_state = {weekday: defaultdict(float) for weekday in weekdays}
+    first_weekday_idx = 0
+    for (timestamp, state), (next_timestamp, _) in zip(logs[:-1], logs[1:]):
+        # Skip the weekdays that end before this interval starts, they cannot overlap anymore
+        while (first_weekday_idx < len(weekdays)
+               and weekday_timestamps[weekdays[first_weekday_idx]][1] <= timestamp):
+            first_weekday_idx += 1
+        for weekday in weekdays[first_weekday_idx:]:
+            weekday_start, weekday_end = weekday_timestamps[weekday]
+            if weekday_start >= next_timestamp:
+                break  # The remaining weekdays start after the interval ends
+            overlap = min(next_timestamp, weekday_end) - max(timestamp, weekday_start)
+            if overlap > 0:
+                cum_times_per_weekday_state[weekday][state] += overlap
+    return cum_times_per_weekday_state
 
 
 def get_work_time(start_timestamp, end_timestamp):
-    cum_times = get_cum_times_per_state(start_timestamp, end_timestamp)
-    return sum(cum_times[state] for state in WorktimeTracker.work_states)
+    return float(get_cum_state_durations(start_timestamp, end_timestamp) @ WORK_STATES_MASK)
 
 
 class WorktimeTracker:
 
-    states = ['work', 'personal', 'locked']
-    work_states = ['work']
+    states = STATES
+    work_states = WORK_STATES
     targets = {
         0: 6.25 * 3600,  # Monday
         1: 6.25 * 3600,  # Tuesday
@@ -166,46 +225,104 @@ class WorktimeTracker:
     day_start_hour = 7  # Hour at which the day starts
 
     def __init__(self, read_only=False):
-        maybe_fix_unfinished_work_state()
+        self._open_log_file()
+        atexit.register(self._close_log_file)
+        self._last_log = read_last_log()  # Kept in memory so the polling path does not reread the file
+        self._work_times_per_weekday = None  # Maintained incrementally by get_work_times_per_weekday
+        self._accum_timestamp = None  # Time up to which _work_times_per_weekday is summed
+        self._accum_generation = None  # LOGS_GENERATION when the accumulator was last in sync
+        self.maybe_fix_unfinished_work_state()
         self.read_only = read_only
 
+    def _open_log_file(self):
+        # Keep a long-lived append-only file descriptor instead of an open/write/close per log
+        self._log_fd = os.open(LOGS_PATH, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self._log_generation = LOGS_GENERATION
+
+    def _close_log_file(self):
+        os.close(self._log_fd)
+
+    def maybe_fix_unfinished_work_state(self):
+        '''If the app was killed during a work state, it will count everything from this moment as work.
+        We want to fix it if this is the case'''
+        if self._last_log is None:
+            return
+        timestamp = time.time()
+        last_check_timestamp = read_last_check_timestamp()
+        _, last_state = self._last_log
+        if timestamp - last_check_timestamp < 60:
+            return
+        if last_state not in WorktimeTracker.work_states:
+            return
+        write_last_check(timestamp)
+        self.maybe_write_log(last_check_timestamp + 1, 'locked')
+
+    def maybe_write_log(self, timestamp, state):
+        # TODO: lock file
+        last_state = self._last_log[1] if self._last_log is not None else None
+        if last_state == state:
+            return
+        global LOGS_SIGNATURE
+        if self._log_generation != LOGS_GENERATION:
+            # The log file was replaced (rewrite_history), the descriptor points to the old file
+            self._close_log_file()
+            self._open_log_file()
+        get_all_logs()  # Sync the loaded logs before appending to them in place
+        os.write(self._log_fd, f'{timestamp}\t{state}\n'.encode())
+        # Update the loaded logs in place so the next get_all_logs call does not need to reparse
+        stat = os.fstat(self._log_fd)
+        LOGS_SIGNATURE = (stat.st_size, stat.st_mtime_ns)
+        ALL_LOGS.append((timestamp, state))
+        LOG_TIMESTAMPS.append(timestamp)
+        LOG_STATE_CODES.append(STATE_CODES[state])
+        self._last_log = (timestamp, state)
+
     @staticmethod
     def is_work_state(state):
         return state in WorktimeTracker.work_states
 
     @property
     def current_state(self):
-        return read_last_log()[1]
+        if self._last_log is None:
+            return read_last_log()[1]
+        return self._last_log[1]
 
     def get_work_ratio_since_timestamp(self, start_timestamp):
         end_timestamp = time.time()
         work_time = get_work_time(start_timestamp, end_timestamp)
         return work_time / (end_timestamp - start_timestamp)
 
+    @staticmethod
+    def get_current_day_bucket():
+        '''Key that changes value exactly when a new day starts (at day_start_hour), used to
+        invalidate the cached day start'''
+        day_time = time.localtime(time.time() - WorktimeTracker.day_start_hour * 3600)
+        return day_time.tm_year, day_time.tm_yday
+
     @staticmethod
     def get_current_weekday():
-        return (datetime.today() - timedelta(hours=WorktimeTracker.day_start_hour)).weekday()
+        return time.localtime(time.time() - WorktimeTracker.day_start_hour * 3600).tm_wday
+
+    @staticmethod
+    @lru_cache(maxsize=8)
+    def _get_day_start(day_bucket):
+        local_time = time.localtime()
+        seconds_since_day_start = (((local_time.tm_hour - WorktimeTracker.day_start_hour) % 24) * 3600
+                                   + local_time.tm_min * 60 + local_time.tm_sec)
+        return float(int(time.time()) - seconds_since_day_start)
 
     @staticmethod
     def get_current_day_start():
-        return (datetime.today() - timedelta(hours=WorktimeTracker.day_start_hour)).replace(
-            hour=WorktimeTracker.day_start_hour,
-            minute=0,
-            second=0,
-            microsecond=0
-        ).timestamp()
+        # Computed once per day: it only changes when the day bucket does
+        return WorktimeTracker._get_day_start(WorktimeTracker.get_current_day_bucket())
 
     @staticmethod
     def get_current_day_end():
-        return WorktimeTracker.get_current_day_start() + timedelta(days=1).total_seconds()
+        return WorktimeTracker.get_current_day_start() + 24 * 3600
 
     @staticmethod
     def get_week_start():
-        delta = timedelta(days=WorktimeTracker.get_current_weekday(), hours=WorktimeTracker.day_start_hour)
-        return (datetime.today() - delta).replace(hour=WorktimeTracker.day_start_hour,
-                                                  minute=0,
-                                                  second=0,
-                                                  microsecond=0).timestamp()
+        return WorktimeTracker.get_current_day_start() - WorktimeTracker.get_current_weekday() * 24 * 3600
 
     @staticmethod
     def is_this_week(query_timestamp):
@@ -222,23 +339,48 @@ class WorktimeTracker:
         current_weekday = WorktimeTracker.get_current_weekday()
         assert weekday <= current_weekday, 'Cannot query future weekday'
         day_offset = current_weekday - weekday
-        weekday_start = WorktimeTracker.get_current_day_start() - timedelta(days=day_offset).total_seconds()
-        weekday_end = WorktimeTracker.get_current_day_end() - timedelta(days=day_offset).total_seconds()
+        weekday_start = WorktimeTracker.get_current_day_start() - day_offset * 24 * 3600
+        weekday_end = weekday_start + 24 * 3600
         return weekday_start, weekday_end
 
     def get_work_time_from_weekday(self, weekday):
         weekday_start, weekday_end = WorktimeTracker.get_weekday_timestamps(weekday)
         return get_work_time(weekday_start, weekday_end)
 
+    def get_work_times_per_weekday(self):
+        '''Work times of all the weekdays of the current week so far. Maintained incrementally:
+        between two calls only the interval elapsed since the previous one is summed, the whole
+        week of logs is only walked on startup, day rollover or history rewrite'''
+        now = time.time()
+        current_weekday = WorktimeTracker.get_current_weekday()
+        needs_resync = (
+            self._work_times_per_weekday is None
+            or self._accum_generation != LOGS_GENERATION  # The history was rewritten
+            or WorktimeTracker.get_current_day_start() > self._accum_timestamp  # Day rollover
+        )
+        if needs_resync:
+            weekday_timestamps = {weekday: WorktimeTracker.get_weekday_timestamps(weekday)
+                                  for weekday in range(current_weekday + 1)}
+            cum_times_per_weekday_state = get_cum_times_per_weekday_state(weekday_timestamps)
+            self._work_times_per_weekday = {
+                weekday: sum(cum_times[state] for state in WorktimeTracker.work_states)
+                for weekday, cum_times in cum_times_per_weekday_state.items()
+            }
+        elif now > self._accum_timestamp:
+            self._work_times_per_weekday[current_weekday] += get_work_time(self._accum_timestamp, now)
+        self._accum_timestamp = now
+        self._accum_generation = LOGS_GENERATION
+        return self._work_times_per_weekday
+
     def maybe_append_and_write_log(self, timestamp, state):
         if self.read_only:
             False
-        maybe_write_log(timestamp, state)
+        self.maybe_write_log(timestamp, state)
 
     def check_state(self):
         '''Checks the current state and update the logs. Returns a boolean of whether the state changed or not'''
         # TODO: We should split the writing logic and the state checking logic
-        _, last_state = read_last_log()
+        last_state = self._last_log[1] if self._last_log is not None else None
         state = get_state()
         timestamp = time.time()
         write_last_check(timestamp)
@@ -247,15 +389,17 @@ class WorktimeTracker:
 
     def lines(self):
         '''Nicely formatted lines for displaying to the user'''
+        work_times = self.get_work_times_per_weekday()
+
         def weekday_text(weekday_idx):
             weekday = WorktimeTracker.weekdays[weekday_idx]
-            work_time = self.get_work_time_from_weekday(weekday_idx)
+            work_time = work_times[weekday_idx]
             target = WorktimeTracker.targets[weekday_idx]
             ratio = work_time / target if target != 0 else 1
             return f'{weekday[:3]}: {int(100 * ratio)}% ({seconds_to_human_readable(work_time)})'
 
         def total_worktime_text():
-            work_time = sum([self.get_work_time_from_weekday(weekday_idx)
+            work_time = sum([work_times[weekday_idx]
                              for weekday_idx in range(WorktimeTracker.get_current_weekday())])
             target = sum([WorktimeTracker.targets[weekday_idx]
                           for weekday_idx in range(WorktimeTracker.get_current_weekday())])